@@ -5,9 +5,10 @@ from __future__ import annotations
 import argparse
 import re
 import sys
+from bisect import bisect_left
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional, Sequence, Tuple
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 
 import xml.etree.ElementTree as ET
 
@@ -41,9 +42,30 @@ _MATPLOTLIB_PREFIXES = (
     "mpl_toolkits",
 )
 
+# Walks the opening tag one attribute at a time, so a quoted '>' in an earlier
+# attribute value does not end the tag before id is reached. The id itself may be
+# quoted either way, matching what the parser accepts.
+_ID_TAG_RE = re.compile(
+    r"<(?P<tag>[\w:-]+)(?:\s+(?!id\s*=)[^\s=>/]+\s*=\s*(?:\"[^\"]*\"|'[^']*'))*"
+    r"\s+id\s*=\s*(?:\"(?P<id>[^\"]+)\"|'(?P<sq_id>[^']+)')"
+)
+_OPEN_TAG_RE = re.compile(r"""<(?:[^>"']|"[^"]*"|'[^']*')*>""")
+_GROUP_TAG_RE = re.compile(r"""<(/?)g\b(?:[^>"'/]|"[^"]*"|'[^']*'|/(?!>))*(/?)>""")
+
+_URL_REF_RE = re.compile(r"url\(#([^)]+)\)")
+_REFERENCE_ATTRS = frozenset({"marker-start", "marker-mid", "marker-end", "filter", "clip-path"})
+# Cheap prefilter for _collect_referenced_ids; it must match everything the element walk accepts.
+_REFERENCE_HINT_RE = re.compile(
+    r"url\(#|(?:path-effect[\w:-]*|"
+    + "|".join(re.escape(attr) for attr in sorted(_REFERENCE_ATTRS))
+    + r")\s*=\s*[\"']#"
+)
+
 
 @dataclass
 class _CandidateGroup:
+    __slots__ = ("group_id", "element", "snippet", "start", "end")
+
     group_id: str
     element: ET.Element
     snippet: str
@@ -51,82 +73,149 @@ class _CandidateGroup:
     end: int
 
 
+_Edit = Tuple[int, int, str]
+
+
+@dataclass
+class _StreamFrame:
+    __slots__ = ("element", "group_id", "pruned", "has_figure", "found")
+
+    element: ET.Element
+    group_id: Optional[str]
+    pruned: bool
+    has_figure: bool
+    found: List[str]
+
+
+@dataclass
+class _TagEvents:
+    positions: List[int]
+    deltas: List[int]
+    ends: List[int]
+
+
+@dataclass
+class _DocumentIndex:
+    ids: Dict[str, re.Match[str]]
+    group_events: _TagEvents
+
+
 def _local_name(tag: str) -> str:
-    return tag.split("}")[-1] if "}" in tag else tag
+    return tag.rpartition("}")[2]
+
+
+def _decode_svg(data: bytes, path: Path) -> str:
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError as exc:
+        raise AnnotationError(f"Could not decode {path} as UTF-8: {exc}") from exc
+    # Same newline handling as Path.read_text, which the "\n"-based markers rely on.
+    return text.replace("\r\n", "\n").replace("\r", "\n")
 
 
 def _ensure_trailing_newline(text: str) -> str:
     return text if text.endswith("\n") else text + "\n"
 
 
-def _extract_single_tag_with_pos(svg_text: str, element_id: str) -> Optional[Tuple[str, int]]:
-    pattern = re.compile(
-        r"<([\\w:-]+)[^>]*id=\"%s\"[^>]*?(?:/>|>.*?</\\1>)" % re.escape(element_id),
-        re.DOTALL,
-    )
-    match = pattern.search(svg_text)
-    if not match:
+def _indent_start(text: str, pos: int) -> int:
+    while pos > 0 and text[pos - 1] in " \t":
+        pos -= 1
+    return pos
+
+
+def _skip_newline(text: str, pos: int) -> int:
+    return pos + 1 if text.startswith("\n", pos) else pos
+
+
+def _index_tag_events(svg_text: str) -> _TagEvents:
+    positions: List[int] = []
+    deltas: List[int] = []
+    ends: List[int] = []
+    for match in _GROUP_TAG_RE.finditer(svg_text):
+        positions.append(match.start())
+        # A self-closing <g/> opens and closes in one event.
+        deltas.append(-1 if match.group(1) else 0 if match.group(2) else 1)
+        ends.append(match.end())
+    return _TagEvents(positions, deltas, ends)
+
+
+def _tag_block_end(events: _TagEvents, open_start: int) -> int:
+    depth = 0
+    for idx in range(bisect_left(events.positions, open_start), len(events.positions)):
+        depth += events.deltas[idx]
+        if depth == 0:
+            return events.ends[idx]
+    return -1
+
+
+def _element_end(svg_text: str, open_start: int, tag: str) -> int:
+    # Self-closing tag, or everything up to the first matching close tag.
+    opening = _OPEN_TAG_RE.match(svg_text, open_start)
+    if not opening:
+        return -1
+    if svg_text[opening.end() - 2] == '/':
+        return opening.end()
+    close_tag = f"</{tag}>"
+    close_idx = svg_text.find(close_tag, opening.end())
+    return -1 if close_idx == -1 else close_idx + len(close_tag)
+
+
+def _extract_tag_block_with_pos(svg_text: str, index: _DocumentIndex, element_id: str) -> Optional[Tuple[str, int]]:
+    match = index.ids.get(element_id)
+    if not match or match.group('tag') != 'g':
+        return None
+    open_start = match.start()
+    end_pos = _tag_block_end(index.group_events, open_start)
+    if end_pos == -1:
         return None
-    return match.group(0), match.start()
+    return svg_text[open_start:end_pos], open_start
+
+
+def _index_document(svg_text: str) -> _DocumentIndex:
+    # Built back to front so the first occurrence of a duplicated id wins.
+    matches = list(_ID_TAG_RE.finditer(svg_text))
+    ids: Dict[str, re.Match[str]] = {
+        match.group('id') or match.group('sq_id'): match for match in reversed(matches)
+    }
+    return _DocumentIndex(ids, _index_tag_events(svg_text))
 
 
-def _extract_tag_block_with_pos(svg_text: str, element_id: str, tag: str = "g") -> Optional[Tuple[str, int]]:
-    id_token = f'id="{element_id}"'
-    id_pos = svg_text.find(id_token)
-    if id_pos == -1:
+def _extract_single_tag_with_pos(
+    svg_text: str, index: _DocumentIndex, element_id: str
+) -> Optional[Tuple[str, int]]:
+    match = index.ids.get(element_id)
+    if not match:
         return None
-    open_start = svg_text.rfind(f"<{tag}", 0, id_pos)
-    if open_start == -1:
+    open_start = match.start()
+    end_pos = _element_end(svg_text, open_start, match.group('tag'))
+    if end_pos == -1:
         return None
-    segment = svg_text[open_start:]
-    depth = 0
-    for match in re.finditer(rf"</?{tag}\b", segment):
-        token = match.group()
-        if token == f"<{tag}":
-            depth += 1
-        else:
-            depth -= 1
-            if depth == 0:
-                close_idx = segment.find('>', match.start())
-                if close_idx == -1:
-                    return None
-                end_pos = open_start + close_idx + 1
-                return svg_text[open_start:end_pos], open_start
-    return None
+    return svg_text[open_start:end_pos], open_start
 
 
 def _looks_like_matplotlib_group(group_id: str) -> bool:
-    lid = group_id.lower()
-    return any(lid.startswith(prefix) for prefix in _MATPLOTLIB_PREFIXES)
-
+    return group_id.lower().startswith(_MATPLOTLIB_PREFIXES)
 
-def _discover_candidate_groups(root: ET.Element, svg_text: str) -> List[_CandidateGroup]:
-    parent_map = {child: parent for parent in root.iter() for child in parent}
 
+def _discover_candidate_groups(root: ET.Element, svg_text: str, index: _DocumentIndex) -> List[_CandidateGroup]:
     raw_candidates: List[_CandidateGroup] = []
-    for element in root.iter():
-        if _local_name(element.tag) != 'g':
-            continue
+    stack: List[ET.Element] = [root]
+    while stack:
+        element = stack.pop()
         gid = element.get('id')
-        if not gid or gid == 'figure_1':
-            continue
-        if _looks_like_matplotlib_group(gid):
+        if gid and (gid == 'figure_1' or _looks_like_matplotlib_group(gid)):
+            # Nothing below a Matplotlib-owned element can be an overlay; prune the subtree.
             continue
+        stack.extend(element)
 
-        parent = parent_map.get(element)
-        skip = False
-        while parent is not None:
-            pid = parent.get('id')
-            if pid and (pid == 'figure_1' or _looks_like_matplotlib_group(pid)):
-                skip = True
-                break
-            parent = parent_map.get(parent)
-        if skip:
+        if not gid:
+            continue
+        if _local_name(element.tag) != 'g':
             continue
-        if len(element.attrib) == 1 and element.attrib.get('id'):
+        if len(element.attrib) == 1:
             continue
 
-        extracted = _extract_tag_block_with_pos(svg_text, gid, tag='g')
+        extracted = _extract_tag_block_with_pos(svg_text, index, gid)
         if extracted is None:
             continue
         snippet, start = extracted
@@ -136,11 +225,15 @@ def _discover_candidate_groups(root: ET.Element, svg_text: str) -> List[_Candida
 
     raw_candidates.sort(key=lambda cand: cand.start)
 
+    # Blocks are well-formed XML sorted by start, so anything starting before the
+    # end of the last accepted block is nested inside it.
     candidates: List[_CandidateGroup] = []
+    current_end = -1
     for cand in raw_candidates:
-        if any(cand.start >= existing.start and cand.end <= existing.end for existing in candidates):
+        if cand.start < current_end:
             continue
         candidates.append(cand)
+        current_end = cand.end
     return candidates
 
 
@@ -151,14 +244,13 @@ def _collect_referenced_ids(element: ET.Element) -> List[str]:
         for attr, value in node.attrib.items():
             if not isinstance(value, str):
                 continue
-            for ref in re.findall(r"url\(#([^\)]+)\)", value):
-                if ref not in seen:
-                    refs.append(ref)
-                    seen.add(ref)
-            if (
-                ("path-effect" in attr or attr in {"marker-start", "marker-mid", "marker-end", "filter", "clip-path"})
-                and value.startswith('#')
-            ):
+            if 'url(' in value:
+                for match in _URL_REF_RE.finditer(value):
+                    ref = match.group(1)
+                    if ref not in seen:
+                        refs.append(ref)
+                        seen.add(ref)
+            if value.startswith('#') and ("path-effect" in attr or attr in _REFERENCE_ATTRS):
                 ref = value[1:]
                 if ref not in seen:
                     refs.append(ref)
@@ -166,58 +258,136 @@ def _collect_referenced_ids(element: ET.Element) -> List[str]:
     return refs
 
 
-def _insert_or_replace_definition(dest_text: str, element_id: str, snippet: str) -> Tuple[str, bool]:
+def _group_insertion_anchor(dest_text: str) -> int:
+    marker_idx = dest_text.find("\n </g>\n <defs>")
+    if marker_idx == -1:
+        marker_idx = dest_text.find("\n</svg>")
+    return marker_idx
+
+
+def _insert_or_replace_definition(
+    dest_text: str, dest_index: _DocumentIndex, element_id: str, snippet: str, anchor: int
+) -> _Edit:
     prepared = _ensure_trailing_newline(snippet)
-    pattern = re.compile(
-        r"[ \t]*<[\\w:-]+[^>]*id=\"%s\"[^>]*?(?:/>|>.*?</[\\w:-]+>)\n?" % re.escape(element_id),
-        re.DOTALL,
-    )
-    match = pattern.search(dest_text)
+    match = dest_index.ids.get(element_id)
     if match:
-        new_text = dest_text[: match.start()] + prepared + dest_text[match.end():]
-        return new_text, new_text != dest_text
+        end = _element_end(dest_text, match.start(), match.group('tag'))
+        if end != -1:
+            return _indent_start(dest_text, match.start()), _skip_newline(dest_text, end), prepared
 
-    close_idx = dest_text.find("</defs>")
-    if close_idx == -1:
+    if anchor == -1:
         raise AnnotationError("Destination SVG missing </defs> tag for annotation defs")
+    return anchor, anchor, prepared
 
-    insertion = prepared
-    if close_idx > 0 and dest_text[close_idx - 1] != "\n":
-        insertion = "\n" + insertion
-    new_text = dest_text[:close_idx] + insertion + dest_text[close_idx:]
-    return new_text, True
 
-
-def _insert_or_replace_group(dest_text: str, element_id: str, snippet: str) -> Tuple[str, bool]:
+def _insert_or_replace_group(
+    dest_text: str, dest_index: _DocumentIndex, element_id: str, snippet: str, anchor: int
+) -> _Edit:
     prepared = _ensure_trailing_newline(snippet)
-    pattern = re.compile(r"[ \t]*<g[^>]*id=\"%s\"[^>]*>.*?</g>\n?" % re.escape(element_id), re.DOTALL)
-    match = pattern.search(dest_text)
-    if match:
-        new_text = dest_text[: match.start()] + prepared + dest_text[match.end():]
-        return new_text, new_text != dest_text
+    match = dest_index.ids.get(element_id)
+    if match and match.group('tag') == 'g':
+        end = _tag_block_end(dest_index.group_events, match.start())
+        if end != -1:
+            return _indent_start(dest_text, match.start()), _skip_newline(dest_text, end), prepared
+    return _group_insertion(snippet, anchor)
 
-    marker = "\n </g>\n <defs>"
-    marker_idx = dest_text.find(marker)
-    if marker_idx == -1:
-        marker = "\n</svg>"
-        marker_idx = dest_text.find(marker)
-        if marker_idx == -1:
-            raise AnnotationError("Could not locate insertion point for annotation groups in target SVG")
 
-    insertion = prepared
-    if marker_idx > 0 and dest_text[marker_idx - 1] != "\n":
-        insertion = "\n" + insertion
-    new_text = dest_text[:marker_idx] + insertion + dest_text[marker_idx:]
-    return new_text, True
+def _group_insertion(snippet: str, anchor: int) -> _Edit:
+    if anchor == -1:
+        raise AnnotationError("Could not locate insertion point for annotation groups in target SVG")
+    return anchor, anchor, _ensure_trailing_newline(snippet)
+
+
+def _edit_changes_text(text: str, edit: _Edit) -> bool:
+    start, end, replacement = edit
+    return text[start:end] != replacement
+
+
+def _swallowed_replacements(text: str, edits: Sequence[_Edit]) -> Set[int]:
+    # Indices of replacements lying inside another replacement that changes the text;
+    # their target block disappears when the enclosing one is rewritten.
+    order = sorted(
+        (idx for idx, (start, end, _) in enumerate(edits) if start != end),
+        key=lambda idx: (edits[idx][0], -edits[idx][1]),
+    )
+    swallowed: Set[int] = set()
+    reach = -1
+    for idx in order:
+        start, end, _ = edits[idx]
+        if end <= reach:
+            swallowed.add(idx)
+        elif _edit_changes_text(text, edits[idx]):
+            reach = end
+    return swallowed
+
+
+def _apply_edits(text: str, edits: Sequence[_Edit]) -> str:
+    pieces: List[str] = []
+    cursor = 0
+    last_char = ""
+    for start, end, replacement in sorted(edits, key=lambda edit: edit[0]):
+        if start < cursor:
+            if start != end:
+                # Nested inside a block that has already been replaced.
+                continue
+            # The insertion anchor was swallowed by a replacement; emit right after it.
+            start = end = cursor
+        if start > cursor:
+            pieces.append(text[cursor:start])
+            last_char = text[start - 1]
+        if start == end and last_char and last_char != "\n":
+            replacement = "\n" + replacement
+        pieces.append(replacement)
+        if replacement:
+            last_char = replacement[-1]
+        cursor = end
+    pieces.append(text[cursor:])
+    return "".join(pieces)
 
 
 def list_overlay_groups(svg_path: Path) -> List[str]:
-    text = svg_path.read_text()
+    # Stream the document so memory tracks nesting depth rather than file size.
+    frames: List[_StreamFrame] = []
+    groups: List[str] = []
+    # copy_annotations resolves an id to its first occurrence, so only that element can be copied.
+    seen_ids: Set[str] = set()
     try:
-        root = ET.fromstring(text)
+        for event, element in ET.iterparse(svg_path, events=('start', 'end')):
+            if event == 'start':
+                gid = element.get('id')
+                pruned = bool(frames) and frames[-1].pruned
+                first_occurrence = bool(gid) and gid not in seen_ids
+                if gid:
+                    seen_ids.add(gid)
+                if gid and (gid == 'figure_1' or _looks_like_matplotlib_group(gid)):
+                    pruned = True
+                is_candidate = (
+                    not pruned
+                    and bool(gid)
+                    and _local_name(element.tag) == 'g'
+                    and len(element.attrib) > 1
+                    and first_occurrence
+                )
+                frames.append(_StreamFrame(element, gid if is_candidate else None, pruned, gid == 'figure_1', []))
+                continue
+
+            frame = frames.pop()
+            if frame.group_id is not None and not frame.has_figure:
+                # An accepted overlay swallows any candidates nested inside it.
+                found = [frame.group_id]
+            else:
+                found = frame.found
+            element.clear()
+            if frames:
+                parent = frames[-1]
+                parent.found.extend(found)
+                parent.has_figure = parent.has_figure or frame.has_figure
+                parent.element.remove(element)
+            else:
+                groups.extend(found)
     except ET.ParseError as exc:
         raise AnnotationError(f"Could not parse {svg_path}: {exc}") from exc
-    return [cand.group_id for cand in _discover_candidate_groups(root, text)]
+    return groups
 
 
 def copy_annotations(
@@ -238,15 +408,17 @@ def copy_annotations(
     if not target_path.exists():
         raise AnnotationError(f"Target SVG not found: {target_path}")
 
-    src_text = source_path.read_text()
-    dest_text = target_path.read_text()
-
+    # The parser takes the raw bytes directly; the decoded text is only needed for slicing snippets.
+    src_bytes = source_path.read_bytes()
     try:
-        src_root = ET.fromstring(src_text)
+        src_root = ET.fromstring(src_bytes)
     except ET.ParseError as exc:
         raise AnnotationError(f"Could not parse {source_path}: {exc}") from exc
+    src_text = _decode_svg(src_bytes, source_path)
+    dest_text = _decode_svg(target_path.read_bytes(), target_path)
 
-    candidates = _discover_candidate_groups(src_root, src_text)
+    src_index = _index_document(src_text)
+    candidates = _discover_candidate_groups(src_root, src_text, src_index)
 
     if include:
         include_set = set(include)
@@ -265,9 +437,12 @@ def copy_annotations(
     for cand in candidates:
         snippet = cand.snippet
         group_snippets.append((cand.start, cand.group_id, snippet))
+        if not _REFERENCE_HINT_RE.search(snippet):
+            # Nothing in the raw block looks like a reference, so walking its elements would find none.
+            continue
         for ref in _collect_referenced_ids(cand.element):
             if ref not in ref_seen:
-                extracted = _extract_single_tag_with_pos(src_text, ref)
+                extracted = _extract_single_tag_with_pos(src_text, src_index, ref)
                 if extracted is not None:
                     snippet_def, pos = extracted
                     definition_snippets.append((pos, ref, snippet_def))
@@ -276,22 +451,39 @@ def copy_annotations(
     definition_snippets.sort(key=lambda item: item[0])
     group_snippets.sort(key=lambda item: item[0])
 
-    new_text = dest_text
-    changed = False
+    dest_index = _index_document(dest_text)
+    # Every edit targets the original text, so the insertion anchors only need locating once.
+    defs_anchor = dest_text.find("</defs>")
+    group_anchor = _group_insertion_anchor(dest_text)
+    edits: List[_Edit] = []
+    def_end = -1
+    for pos, def_id, snippet in definition_snippets:
+        if pos < def_end:
+            # Already carried along by an enclosing definition.
+            continue
+        def_end = pos + len(snippet)
+        edit = _insert_or_replace_definition(dest_text, dest_index, def_id, snippet, defs_anchor)
+        if _edit_changes_text(dest_text, edit):
+            edits.append(edit)
 
-    for _, def_id, snippet in definition_snippets:
-        new_text, updated = _insert_or_replace_definition(new_text, def_id, snippet)
-        changed = changed or updated
+    group_edits = [
+        _insert_or_replace_group(dest_text, dest_index, gid, snippet, group_anchor)
+        for _, gid, snippet in group_snippets
+    ]
+    swallowed = _swallowed_replacements(dest_text, group_edits)
 
     copied_groups: List[str] = []
-    for _, gid, snippet in group_snippets:
-        new_text, updated = _insert_or_replace_group(new_text, gid, snippet)
-        if updated:
+    for idx, (_, gid, snippet) in enumerate(group_snippets):
+        edit = group_edits[idx]
+        if idx in swallowed:
+            # The target copy is nested in a group being replaced and would vanish with it.
+            edit = _group_insertion(snippet, group_anchor)
+        if _edit_changes_text(dest_text, edit):
+            edits.append(edit)
             copied_groups.append(gid)
-            changed = True
 
-    if changed and not dry_run:
-        target_path.write_text(new_text)
+    if edits and not dry_run:
+        target_path.write_text(_apply_edits(dest_text, edits), encoding="utf-8")
 
     return copied_groups
 